@@ -1,11 +1,13 @@
 """
 Batch-test the Gemini API against the Hugging Face `emotion` dataset using
-blocks of 4 samples per request. The model must answer with JSON so we can
-compare predictions with the dataset ground truth.
+blocks of samples per request (16 by default, see --block-size). The model
+must answer with JSON so we can compare predictions with the dataset ground
+truth.
 
 Usage examples:
   python test_gemini_blocks.py --blocks 2
   python test_gemini_blocks.py --blocks 5 --model gemini-1.5-flash
+  python test_gemini_blocks.py --blocks 4 --block-size 32
 
 Requires environment variable GEMINI_API_KEY (or VITE_GEMINI_API_KEY).
 """
@@ -13,28 +15,38 @@ Requires environment variable GEMINI_API_KEY (or VITE_GEMINI_API_KEY).
 from __future__ import annotations
 
 import argparse
-import json
 import os
 import re
 import sys
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from dataclasses import dataclass
-from itertools import chain
-from typing import Any, Dict, Iterable, List, Sequence
+from functools import lru_cache
+from typing import Any, Dict, Iterable, List, Sequence, Tuple
 
 import google.generativeai as genai
+import orjson
 from datasets import load_dataset
+from google.api_core import exceptions as google_exceptions
+from tenacity import retry, retry_if_exception_type, stop_after_attempt, wait_exponential
 from tqdm import tqdm
 
 
-LABELS: Sequence[str] = ["sadness", "joy", "love", "anger", "fear", "surprise"]
-BLOCK_SIZE = 4
-TOKENS_PER_SENTENCE = 512
+LABELS: Tuple[str, ...] = ("sadness", "joy", "love", "anger", "fear", "surprise")
+DEFAULT_BLOCK_SIZE = 16
+# Each result is only a local_id and a label; the rest leaves room for the JSON wrapper.
+TOKENS_PER_SENTENCE = 32
+# Fixed headroom on top of the per-sentence budget: thinking models such as
+# gemini-2.5-flash count their reasoning tokens against max_output_tokens, so
+# without it a block can stop at MAX_TOKENS with truncated or empty JSON. This
+# also keeps the budget at or above the old 2048-token default.
+RESPONSE_OVERHEAD_TOKENS = 2048
 DEFAULT_MODEL = "gemini-2.5-flash"
+DEFAULT_WORKERS = 8
+# max_output_tokens depends on --block-size and is filled in by main().
 GENERATION_CONFIG = {
     "temperature": 0,
     "top_p": 1,
     "top_k": 1,
-    "max_output_tokens": BLOCK_SIZE * TOKENS_PER_SENTENCE,
     "response_mime_type": "application/json",
 }
 
@@ -60,8 +72,15 @@ SYNONYMS: Dict[str, str] = {
     "loving": "love",
 }
 
+# Canonical labels map to themselves so normalization is a single dict lookup.
+LABEL_MAP: Dict[str, str] = {label: label for label in LABELS}
+LABEL_MAP.update(SYNONYMS)
 
-@dataclass
+_FENCE_RE = re.compile(r"```(?:json)?", re.IGNORECASE)
+_LABEL_RE = re.compile(r"[^a-zA-Z ]")
+
+
+@dataclass(slots=True, frozen=True)
 class Sample:
     dataset_index: int
     sentence: str
@@ -69,92 +88,121 @@ class Sample:
     local_id: int  # 1-based index inside the block
 
 
+def positive_int(raw: str) -> int:
+    """argparse type for counts that must be at least 1."""
+    try:
+        value = int(raw)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"invalid int value: {raw!r}") from None
+    if value < 1:
+        raise argparse.ArgumentTypeError(f"must be a positive integer, got {value}")
+    return value
+
+
 def parse_args() -> argparse.Namespace:
-    parser = argparse.ArgumentParser(description="Test Gemini on the emotion dataset using 4-sample blocks.")
-    parser.add_argument("--blocks", type=int, default=1, help="Number of 4-sample blocks to process.")
+    parser = argparse.ArgumentParser(description="Test Gemini on the emotion dataset using fixed-size sample blocks.")
+    parser.add_argument("--blocks", type=positive_int, default=1, help="Number of sample blocks to process.")
+    parser.add_argument(
+        "--block-size",
+        dest="block_size",
+        type=positive_int,
+        default=DEFAULT_BLOCK_SIZE,
+        help=f"Sentences sent per Gemini request (default: {DEFAULT_BLOCK_SIZE}).",
+    )
     parser.add_argument("--model", default=DEFAULT_MODEL, help="Gemini model to invoke.")
     parser.add_argument("--split", default="test", help="Dataset split to read (default: test).")
     parser.add_argument("--api-key", dest="api_key", default=None, help="Gemini API key (fallback to env vars).")
+    parser.add_argument(
+        "--workers",
+        type=positive_int,
+        default=DEFAULT_WORKERS,
+        help=f"Maximum number of concurrent Gemini requests (default: {DEFAULT_WORKERS}).",
+    )
     return parser.parse_args()
 
 
 def get_api_key(cli_key: str | None) -> str:
-    candidate = cli_key or os.getenv("GEMINI_API_KEY") or os.getenv("VITE_GEMINI_API_KEY") or ""
-    key = candidate.strip()
+    sources = (cli_key, os.environ.get("GEMINI_API_KEY"), os.environ.get("VITE_GEMINI_API_KEY"))
+    key = next((value.strip() for value in sources if value and value.strip()), "")
     if not key:
         raise RuntimeError("Missing Gemini API key. Provide --api-key or set GEMINI_API_KEY/VITE_GEMINI_API_KEY.")
     return key
 
 
-def chunk_samples(split: str, block_limit: int) -> Iterable[List[Sample]]:
-    dataset = load_dataset("emotion", split=split)
-    block: List[Sample] = []
-    block_id = 0
-    for idx, row in enumerate(dataset):
-        gold = LABELS[row["label"]]
-        block.append(Sample(dataset_index=idx, sentence=row["text"], gold_emotion=gold, local_id=len(block) + 1))
-        if len(block) == BLOCK_SIZE:
-            yield block
-            block = []
-            block_id += 1
-            if block_id >= block_limit:
-                break
-    # Drop leftover samples to keep each block at BLOCK_SIZE exactly.
-
-
-def build_block_prompt(block_id: int, samples: List[Sample]) -> str:
-    header = (
+def chunk_samples(split: str, block_limit: int, block_size: int = DEFAULT_BLOCK_SIZE) -> Iterable[List[Sample]]:
+    # Stream rows so only the requested number of samples is ever fetched, and
+    # pull each block as one columnar batch instead of converting row by row.
+    dataset = (
+        load_dataset("emotion", split=split, streaming=True)
+        .select_columns(["text", "label"])
+        .take(block_limit * block_size)
+    )
+    # drop_last_batch keeps each block at block_size exactly.
+    for block_index, batch in enumerate(dataset.iter(batch_size=block_size, drop_last_batch=True)):
+        offset = block_index * block_size
+        yield [
+            Sample(dataset_index=offset + slot, sentence=text, gold_emotion=LABELS[label], local_id=slot + 1)
+            for slot, (text, label) in enumerate(zip(batch["text"], batch["label"]))
+        ]
+
+
+@lru_cache(maxsize=None)
+def build_prompt_header(block_size: int) -> str:
+    """Static part of every block prompt; formatted once per block size."""
+    return (
         "You are an emotion classifier. Classify each sentence independently and respond with JSON only.\n"
         f"Allowed labels: {', '.join(LABELS)}.\n"
         "Required JSON schema:\n"
         '{\n'
         '  "block": <block_id>,\n'
         '  "results": [\n'
-        f'    {{"local_id": <1-{BLOCK_SIZE}>, "dataset_index": <int>, "sentence": "<original text>", "predicted_emotion": "<label>"}}\n'
+        f'    {{"local_id": <1-{block_size}>, "predicted_emotion": "<label>"}}\n'
         "  ]\n"
         "}\n"
-        "Do not omit any sentences and keep the sentence text verbatim."
+        "Return one result per sentence and do not repeat the sentence text."
     )
-    lines = [header, f"Block #{block_id} sentences:"]
-    for sample in samples:
-        lines.append(f"{sample.local_id}. dataset_index={sample.dataset_index} :: {sample.sentence}")
-    return "\n".join(lines)
+
+
+def build_block_prompt(block_id: int, samples: Sequence[Sample]) -> str:
+    # Samples are frozen dataclasses, so the block itself can serve as the cache key.
+    return _prompt_for(block_id, tuple(samples))
+
+
+@lru_cache(maxsize=1024)
+def _prompt_for(block_id: int, samples: Tuple[Sample, ...]) -> str:
+    lines = [f"{sample.local_id}. dataset_index={sample.dataset_index} :: {sample.sentence}" for sample in samples]
+    return f"{build_prompt_header(len(samples))}\nBlock #{block_id} sentences:\n" + "\n".join(lines)
 
 
 def sanitize_json_text(raw: str) -> str:
     cleaned = raw.strip()
-    cleaned = re.sub(r"```(?:json)?", "", cleaned, flags=re.IGNORECASE)
-    cleaned = cleaned.replace("```", "").strip()
-    return cleaned
+    # JSON-mode replies normally carry no Markdown fences; skip the regex then.
+    if "```" not in cleaned:
+        return cleaned
+    return _FENCE_RE.sub("", cleaned).replace("```", "").strip()
 
 
 def normalize_label(raw: str) -> str:
-    cleaned = re.sub(r"[^a-zA-Z ]", " ", raw).strip().lower()
+    cleaned = _LABEL_RE.sub(" ", raw).strip().lower()
     if not cleaned:
         return ""
-    token = cleaned.split()[0]
-    if token in LABELS:
-        return token
-    return SYNONYMS.get(token, token)
-
-
-def trim_results_for_export(results: Sequence[Dict[str, Any]]) -> List[Dict[str, str]]:
-    """Return only the fields that must be exposed externally."""
-    trimmed: List[Dict[str, str]] = []
-    for item in results:
-        trimmed.append(
-            {
-                "sentence": str(item.get("sentence", "")),
-                "gold_emotion": str(item.get("gold_emotion", "")),
-                "predicted_emotion": str(item.get("predicted_emotion", "")),
-            }
-        )
-    return trimmed
+    token = cleaned.partition(" ")[0]
+    return LABEL_MAP.get(token, token)
+
+
+def trim_results_for_export(
+    sentences: Sequence[str], golds: Sequence[str], preds: Sequence[str]
+) -> List[Dict[str, str]]:
+    """Zip the per-sample columns into the records that must be exposed externally."""
+    return [
+        {"sentence": sentence, "gold_emotion": gold, "predicted_emotion": pred}
+        for sentence, gold, pred in zip(sentences, golds, preds)
+    ]
 
 
 def compute_accuracy_from_json(payload: str | Dict[str, Any]) -> float:
     """Compute accuracy % from a summary JSON (string or dict)."""
-    data = json.loads(payload) if isinstance(payload, str) else payload
+    data = orjson.loads(payload) if isinstance(payload, str) else payload
     results = data.get("results", [])
     if not isinstance(results, list):
         raise ValueError("Expected 'results' to be a list in the provided JSON payload.")
@@ -173,30 +221,74 @@ def compute_accuracy_from_json(payload: str | Dict[str, Any]) -> float:
 def parse_block_response(raw_text: str) -> Dict:
     cleaned = sanitize_json_text(raw_text)
     try:
-        return json.loads(cleaned)
-    except json.JSONDecodeError as exc:
+        return orjson.loads(cleaned)
+    except orjson.JSONDecodeError as exc:
         raise ValueError(f"Failed to parse model JSON: {exc}: {raw_text}") from exc
 
 
-def evaluate_blocks(model: genai.GenerativeModel, block_iter: Iterable[List[Sample]]) -> Dict:
+@retry(
+    retry=retry_if_exception_type((google_exceptions.ResourceExhausted, google_exceptions.ServiceUnavailable)),
+    wait=wait_exponential(multiplier=1, max=30),
+    stop=stop_after_attempt(5),
+    reraise=True,
+)
+def request_block(model: genai.GenerativeModel, prompt: str) -> str:
+    """Send one block prompt, retrying with backoff on rate-limit/unavailable errors."""
+    response = model.generate_content(prompt, stream=True)
+    # Per-chunk .text/.parts would raise on closing chunks that carry only
+    # finish_reason or usage data; let the library accumulate the stream instead.
+    response.resolve()
+    return response.text or ""
+
+
+def fetch_block(model: genai.GenerativeModel, block_id: int, samples: List[Sample]) -> Dict:
+    """Request and parse one block; runs in a worker so parsing overlaps other in-flight requests."""
+    try:
+        raw_text = request_block(model, build_block_prompt(block_id, samples))
+    except Exception as exc:
+        raise RuntimeError(f"Gemini request failed for block {block_id}") from exc
+    return parse_block_response(raw_text)
+
+
+def evaluate_blocks(
+    model: genai.GenerativeModel,
+    block_iter: Iterable[List[Sample]],
+    workers: int = DEFAULT_WORKERS,
+) -> Dict:
     processed = 0
     total = 0
     correct = 0
-    detailed_results = []
-
-    for block_id, samples in enumerate(block_iter, start=1):
-        prompt = build_block_prompt(block_id, samples)
-        try:
-            response = model.generate_content(prompt)
-        except Exception as exc:
-            raise RuntimeError(f"Gemini request failed for block {block_id}") from exc
-        raw_text = response.text or ""
-        parsed = parse_block_response(raw_text)
+    # Per-sample columns; records are only built once at export time.
+    sentences: List[str] = []
+    golds: List[str] = []
+    preds: List[str] = []
+
+    blocks = list(block_iter)
+    # Requests are independent and network-bound, so dispatch them concurrently
+    # and store each reply at its block index to keep the output order stable.
+    parsed_blocks: List[Dict] = [{}] * len(blocks)
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {
+            executor.submit(fetch_block, model, block_id, samples): block_id
+            for block_id, samples in enumerate(blocks, start=1)
+        }
+        for future in tqdm(as_completed(futures), total=len(futures), desc="Blocks", unit="block"):
+            try:
+                parsed_blocks[futures[future] - 1] = future.result()
+            except Exception:
+                for pending in futures:
+                    pending.cancel()
+                raise
+
+    for samples, parsed in zip(blocks, parsed_blocks):
         predictions: Dict[int, str] = {}
+        slot_count = len(samples)
         for entry in parsed.get("results", []):
-            try:
-                local_id = int(entry["local_id"])
-            except (KeyError, ValueError, TypeError):
+            if not isinstance(entry, dict):
+                continue
+            local_id = entry.get("local_id")
+            # type() rather than isinstance(): bool is an int subclass and `true` is not an id.
+            if type(local_id) is not int or not 1 <= local_id <= slot_count:
                 continue
             predictions[local_id] = normalize_label(str(entry.get("predicted_emotion", "")))
 
@@ -205,33 +297,25 @@ def evaluate_blocks(model: genai.GenerativeModel, block_iter: Iterable[List[Samp
             is_correct = predicted == sample.gold_emotion
             if is_correct:
                 correct += 1
-            detailed_results.append(
-                {
-                    "block": block_id,
-                    "dataset_index": sample.dataset_index,
-                    "sentence": sample.sentence,
-                    "gold_emotion": sample.gold_emotion,
-                    "predicted_emotion": predicted,
-                    "match": is_correct,
-                }
-            )
+            sentences.append(sample.sentence)
+            golds.append(sample.gold_emotion)
+            preds.append(predicted)
             total += 1
         processed += 1
 
+    # Sanity check on the running counter; skipped entirely under `python -O`.
+    assert sum(gold == pred for gold, pred in zip(golds, preds)) == correct
     accuracy = 100 * correct / total if total else 0.0
     model_name = getattr(model, "model_name", DEFAULT_MODEL)
-    trimmed_results = trim_results_for_export(detailed_results)
     summary = {
         "model": model_name,
-        "block_size": BLOCK_SIZE,
+        "block_size": len(blocks[0]) if blocks else 0,
         "blocks_processed": processed,
         "total_sentences": total,
         "accuracy": round(accuracy, 2),
         "correct": correct,
-        "results": trimmed_results,
+        "results": trim_results_for_export(sentences, golds, preds),
     }
-    # accuracy sanity-check derived from the exported JSON structure
-    summary["accuracy"] = compute_accuracy_from_json(summary)
     return summary
 
 
@@ -239,17 +323,19 @@ def main() -> None:
     args = parse_args()
     api_key = get_api_key(args.api_key)
     genai.configure(api_key=api_key)
-    model = genai.GenerativeModel(args.model, generation_config=GENERATION_CONFIG)
+    max_output_tokens = args.block_size * TOKENS_PER_SENTENCE + RESPONSE_OVERHEAD_TOKENS
+    generation_config = {**GENERATION_CONFIG, "max_output_tokens": max_output_tokens}
+    model = genai.GenerativeModel(args.model, generation_config=generation_config)
 
-    block_iter = chunk_samples(args.split, args.blocks)
-    try:
-        first_block = next(block_iter)
-    except StopIteration:
+    blocks = list(chunk_samples(args.split, args.blocks, args.block_size))
+    if not blocks:
         print("No samples found for the requested configuration.", file=sys.stderr)
         sys.exit(1)
 
-    summary = evaluate_blocks(model, tqdm(chain([first_block], block_iter), desc="Blocks", unit="block"))
-    print(json.dumps(summary, ensure_ascii=False, indent=2))
+    summary = evaluate_blocks(model, blocks, workers=args.workers)
+    # orjson emits UTF-8 bytes directly, so skip the str round-trip through print().
+    sys.stdout.buffer.write(orjson.dumps(summary, option=orjson.OPT_INDENT_2 | orjson.OPT_APPEND_NEWLINE))
+    sys.stdout.flush()
 
 
 if __name__ == "__main__":